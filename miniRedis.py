@@ -1,14 +1,27 @@
+import gevent
 from gevent import socket
 from gevent.pool import Pool
 from gevent.server import StreamServer
-from collections import namedtuple
-from io import BytesIO
+from itertools import chain
 from socket import error as socket_error
 import sys
 import pickle
+import struct
+import mmap
 import os
 import time
 import logging
+from typing import Union
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
 now = time.strftime("%Y-%m-%d-%H_%M_%S", time.localtime(time.time()))
 path = './saved_files/'
@@ -17,6 +30,22 @@ if not os.path.exists(path):
 
 FILE_NAME = path + now + "_save_to_disk.pkl"
 
+# 键空间按 hash(key) 分成若干个子字典，单个字典扩容时的停顿随之缩小；必须是2的幂
+SHARD_COUNT = 16
+SHARD_MASK = SHARD_COUNT - 1
+
+# 保存文件格式：魔数 | 8字节pickle长度 | pickle(协议5) | 若干个(8字节长度 | 带外缓冲区)
+SAVE_MAGIC = b'MRP5'
+# 不小于该长度的 bytes 值作为带外缓冲区直接写入文件，不再拷贝进 pickle 流
+OOB_THRESHOLD = 1 << 16
+
+# 键值都是 bytes 时的二进制格式：魔数 | 若干个(4字节键长 | 4字节值长 | 键 | 值)
+KV_MAGIC = b'MRKV'
+KV_HEADER = struct.Struct('<II')
+
+# 安装了 lz4 时，上面的二进制格式改为：魔数 | lz4 帧压缩的若干个(键长 | 值长 | 键 | 值)
+KV_LZ4_MAGIC = b'MRZK'
+
 
 # 用异常通知连接处理中的问题
 class CommandError(Exception):
@@ -29,7 +58,47 @@ class Disconnect(Exception):
     pass
 
 
-Error = namedtuple('Error', ('message',))
+class Error(object):
+    # 用 __slots__ 省去每个实例的 __dict__
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __repr__(self):
+        return 'Error(message=%r)' % (self.message,)
+
+
+# 固定内容的错误预先创建，出错时直接返回同一个对象
+ERR_BAD_REQUEST = Error(b'Request must be list or simple string.')
+ERR_MISSING_COMMAND = Error(b'Missing command')
+
+
+# 整个批量请求无法执行时的错误，作为解析结果直接交给 get_response 返回
+class BatchError(Error):
+    __slots__ = ()
+
+
+ERR_BATCH_UNSUPPORTED = BatchError(
+    b'Batch requests require msgspec on the server.')
+
+# 序列化时标记容器迭代结束的哨兵
+_END = object()
+# 解析时表示缓冲区里还没有一个完整请求的哨兵
+_INCOMPLETE = object()
+
+
+# 以 b'!' 开头的批量请求：大端4字节长度 | msgpack 编码的命令列表
+class Batch(list):
+    pass
+
+
+if msgspec is not None:
+    # 参数类型与 RESP 一致：批量字符串、整数、浮点数和 NULL
+    _batch_decoder = msgspec.msgpack.Decoder(
+        list[list[Union[bytes, int, float, None]]])
+else:
+    _batch_decoder = None
 
 if sys.version_info[0] == 3:
     unicode = str
@@ -37,9 +106,9 @@ if sys.version_info[0] == 3:
 
 
 def encode(s):
-    if isinstance(s, unicode):
+    if isinstance(s, bytes):
         return s
-    elif isinstance(s, bytes):
+    elif isinstance(s, unicode):
         return s.encode('utf-8')
     else:
         return str(s).encode('utf-8')
@@ -54,94 +123,280 @@ def decode(s):
         return str(s)
 
 
+class RecvBuffer(object):
+    # 每个连接一块复用的接收缓冲区，recv_into 直接写入，避免每次 recv 分配新的 bytes
+    def __init__(self, size=65536):
+        self.size = size
+        self.data = bytearray(size)
+        self.start = 0
+        self.end = 0
+        # 请求不完整时保存解析进度：stack 是已解析出部分元素的外层容器，
+        # need 是继续解析前数据至少要到达的位置
+        self.stack = []
+        self.need = 0
+
+    def compact(self):
+        # 把未解析的字节移到缓冲区开头，腾出尾部空间
+        if self.start:
+            remaining = self.end - self.start
+            if len(self.data) > self.size and remaining <= self.size:
+                # 为大请求扩容过的缓冲区在剩余数据放得下时缩回默认大小，不长期占用内存
+                data = bytearray(self.size)
+                data[:remaining] = self.data[self.start:self.end]
+                self.data = data
+            elif remaining:
+                self.data[:remaining] = self.data[self.start:self.end]
+            self.need = max(self.need - self.start, 0)
+            self.start = 0
+            self.end = remaining
+
+
 class ProtocolHandler(object):
+    # 常见的小整数响应和批量字符串长度头预先生成，序列化时直接取用，省去格式化
+    _SMALL_INT = tuple(b':%d\r\n' % i for i in range(1024))
+    _BULK_HEADER = tuple(b'$%d\r\n' % i for i in range(1024))
+
     def __init__(self):
         # 网络中以字节传播，前面写b
+        # 键为首字节的整数值；批量字符串($)、数组(*)和字典(%)直接在 _parse 中处理
         self.handlers = {
-            b'+': self.handle_simple_string,
-            b'-': self.handle_error,
-            b':': self.handle_integer,
-            b'$': self.handle_string,
-            b'*': self.handle_array,
-            b'%': self.handle_dict
+            ord(b'+'): self.handle_simple_string,
+            ord(b'-'): self.handle_error,
+            ord(b':'): self.handle_integer,
+        }
+        # 序列化时按 type(data) 选择写入方法
+        self.writers = {
+            bytes: self.serialize_bytes,
+            str: self.serialize_str,
+            int: self.serialize_number,
+            float: self.serialize_number,
+            bool: self.serialize_bool,
+            Error: self.serialize_error,
+            BatchError: self.serialize_error,
+            list: self.serialize_array,
+            tuple: self.serialize_array,
+            dict: self.serialize_dict,
+            type(None): self.serialize_none,
         }
 
-    def handle_request(self, socket_file):
+    def handle_request(self, conn, reader):
         # 将来自客户端的请求解析为它的组件部分。
-        first_byte = socket_file.read(1)
-        if not first_byte:
-            raise EOFError()
-
+        # reader 是该连接的 RecvBuffer，[start, end) 区间是尚未解析的字节。
+        while True:
+            obj = self.next_buffered(reader)
+            if obj is not _INCOMPLETE:
+                return obj
+            reader.compact()
+            data = reader.data
+            if reader.end == len(data):
+                # 单个请求比缓冲区还大，成倍扩容
+                data.extend(bytes(len(data)))
+            n = conn.recv_into(memoryview(data)[reader.end:])
+            if not n:
+                raise EOFError()
+            reader.end += n
+
+    def next_buffered(self, reader):
+        # 只解析缓冲区里已有的数据；不足一个完整请求时返回 _INCOMPLETE。
+        # 上次缺的数据还没收齐时不再尝试解析。
+        if reader.end <= reader.start or reader.end < reader.need:
+            return _INCOMPLETE
+        return self._parse(reader)
+
+    def _parse(self, reader):
+        # 从 reader.start 开始迭代地解析一个完整的对象并返回；数据不完整时返回 _INCOMPLETE。
+        # 数组/字典用显式栈代替递归，栈保存在 reader 中：请求不完整时已解析的元素保留，
+        # 收到更多数据后从中断处继续，不会重新解析。
+        buf = reader.data
+        pos = reader.start
+        end = reader.end
+        stack = reader.stack
+        if not stack and buf[pos] == 33:  # b'!'
+            return self.handle_batch(reader)
+        handlers = self.handlers
+        find = buf.find
+        while True:
+            crlf = find(b'\r\n', pos, end)
+            if crlf < 0:
+                reader.start = pos
+                reader.need = end + 1
+                return _INCOMPLETE
+            first = buf[pos]
+            if first == 36:  # b'$'，请求参数都是批量字符串，就地解析省去一次方法调用
+                # 命令名、短键的长度和数组元素个数大多只有一位，直接换算比 int() 快
+                if crlf == pos + 2 and 48 <= buf[pos + 1] <= 57:
+                    length = buf[pos + 1] - 48
+                else:
+                    length = int(buf[pos + 1:crlf])
+                if length == -1:
+                    obj = None
+                    pos = crlf + 2
+                else:
+                    stop = crlf + 2 + length
+                    if stop + 2 > end:
+                        # 从这个批量字符串的头部重新开始，数据收齐前不再解析
+                        reader.start = pos
+                        reader.need = stop + 2
+                        return _INCOMPLETE
+                    obj = bytes(memoryview(buf)[crlf + 2:stop])
+                    pos = stop + 2
+            elif first == 42 or first == 37:  # b'*' 或 b'%'
+                if crlf == pos + 2 and 48 <= buf[pos + 1] <= 57:
+                    num = buf[pos + 1] - 48
+                else:
+                    num = int(buf[pos + 1:crlf])
+                pos = crlf + 2
+                if first == 37:
+                    num *= 2
+                if num > 0:
+                    stack.append([first, num, []])
+                    continue
+                obj = {} if first == 37 else []
+            else:
+                handler = handlers.get(first)
+                if handler is None:
+                    obj = bytes(buf[pos:crlf])
+                    pos = crlf + 2
+                else:
+                    obj, pos = handler(buf, pos + 1, crlf)
+
+            # 把解析完的对象放入外层容器，容器填满后继续向上归并
+            while stack:
+                frame = stack[-1]
+                frame[2].append(obj)
+                frame[1] -= 1
+                if frame[1]:
+                    break
+                stack.pop()
+                elements = frame[2]
+                if frame[0] == 37:
+                    obj = dict(zip(elements[::2], elements[1::2]))
+                else:
+                    obj = elements
+            else:
+                reader.start = pos
+                reader.need = 0
+                return obj
+
+    def handle_batch(self, reader):
+        # 整批命令交给 msgspec 在 C 中一次解码，不再逐个解析 RESP
+        buf = reader.data
+        pos = reader.start + 1
+        start = pos + 4
+        if start > reader.end:
+            reader.need = start
+            return _INCOMPLETE
+        stop = start + int.from_bytes(buf[pos:start], 'big')
+        if stop > reader.end:
+            reader.need = stop
+            return _INCOMPLETE
+        reader.start = stop
+        reader.need = 0
+        if _batch_decoder is None:
+            # 没有 msgspec 时也按长度跳过整帧，回复明确的错误，而不是当作内联命令等待换行
+            return ERR_BATCH_UNSUPPORTED
         try:
-            # 根据第一个字节委托给适当的处理程序。
-            return self.handlers[first_byte](socket_file)
-        except KeyError:
-            rest = socket_file.readline().rstrip(b'\r\n')
-            return first_byte + rest
+            commands = _batch_decoder.decode(memoryview(buf)[start:stop])
+        except (msgspec.DecodeError, msgspec.ValidationError) as exc:
+            # 整帧已经消费，回复错误后连接仍可继续使用
+            return BatchError('Invalid batch: %s' % exc)
+        return Batch(commands)
 
-    def handle_simple_string(self, socket_file):
-        return socket_file.readline().rstrip(b'\r\n')
+    def handle_simple_string(self, buf, pos, crlf):
+        return bytes(buf[pos:crlf]), crlf + 2
 
-    def handle_error(self, socket_file):
-        return Error(socket_file.readline().rstrip(b'\r\n'))
+    def handle_error(self, buf, pos, crlf):
+        return Error(bytes(buf[pos:crlf])), crlf + 2
 
-    def handle_integer(self, socket_file):
-        number = socket_file.readline().rstrip(b'\r\n')
+    def handle_integer(self, buf, pos, crlf):
+        number = buf[pos:crlf]
         if b'.' in number:
-            return float(number)
-        return int(number)
-
-    def handle_string(self, socket_file):
-        length = int(socket_file.readline().rstrip(b'\r\n'))
-        if length == -1:
-            return None
-        length += 2
-        return socket_file.read(length)[:-2]
-
-    def handle_array(self, socket_file):
-        num_elements = int(socket_file.readline().rstrip(b'\r\n'))
-        return [self.handle_request(socket_file) for _ in range(num_elements)]
-
-    def handle_dict(self, socket_file):
-        num_items = int(socket_file.readline().rstrip(b'\r\n'))
-        elements = [self.handle_request(socket_file)
-                    for _ in range(num_items * 2)]
-        return dict(zip(elements[::2], elements[1::2]))
+            return float(number), crlf + 2
+        return int(number), crlf + 2
 
     # 对于协议的序列化方面，执行与上述相反的操作：将Python对象转换为其序列化的对象
-    def write_response(self, socket_file, data):
-        # 序列化响应数据，并将它发送给客户端
-        buf = BytesIO()
-        self._write(buf, data)
-        buf.seek(0)
-        socket_file.write(buf.getvalue())
-        socket_file.flush()
-
-    def _write(self, buf, data):
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-
-        if isinstance(data, bytes):
-            buf.write(b'$%d\r\n%s\r\n' % (len(data), data))
-        elif data is True or data is False:
-            buf.write(b':%d\r\n' % (1 if data else 0))
-        elif isinstance(data, (int, float)):
-            buf.write(b':%d\r\n' % data)
-        elif isinstance(data, Error):
-            buf.write(b'-%s\r\n' % encode(data.message))
-        elif isinstance(data, (list, tuple)):
-            buf.write(b'*%d\r\n' % len(data))
-            for item in data:
-                self._write(buf, item)
-        elif isinstance(data, dict):
-            buf.write(b'%%%d\r\n' % len(data))
-            for key in data:
-                self._write(buf, key)
-                self._write(buf, data[key])
-        elif data is None:
-            buf.write(b'$-1\r\n')
+    def write_response(self, conn, data):
+        # 序列化响应数据，拼接后一次性发送给客户端
+        out = []
+        self._serialize(data, out)
+        conn.sendall(b''.join(out))
+
+    def write_responses(self, conn, responses):
+        # 流水线中的多个响应序列化后合并成一次发送
+        out = []
+        for data in responses:
+            self._serialize(data, out)
+        conn.sendall(b''.join(out))
+
+    def _serialize(self, data, out):
+        # 把 data 序列化成若干 bytes 片段追加到 out；嵌套容器用显式的迭代器栈代替递归
+        append = out.append
+        writers = self.writers
+        stack = []
+        while True:
+            # 按 type(data) 直接查表，子类型等查不到时再逐个 isinstance 判断
+            writer = writers.get(type(data))
+            if writer is None:
+                writer = self._find_writer(data)
+            writer(data, append, stack)
+
+            # 取下一个待序列化的元素，已耗尽的容器出栈
+            while stack:
+                data = next(stack[-1], _END)
+                if data is not _END:
+                    break
+                stack.pop()
+            else:
+                return
+
+    def _find_writer(self, data):
+        # 顺序有意义：bool 是 int 的子类
+        for types, writer in (
+                (str, self.serialize_str),
+                (bytes, self.serialize_bytes),
+                (bool, self.serialize_bool),
+                ((int, float), self.serialize_number),
+                (Error, self.serialize_error),
+                ((list, tuple), self.serialize_array),
+                (dict, self.serialize_dict)):
+            if isinstance(data, types):
+                return writer
+        raise CommandError('未能识别的类型： %s' % type(data))
+
+    def serialize_str(self, data, append, stack):
+        self.serialize_bytes(data.encode('utf-8'), append, stack)
+
+    def serialize_bytes(self, data, append, stack):
+        length = len(data)
+        if length < 1024:
+            append(self._BULK_HEADER[length])
+        else:
+            append(b'$%d\r\n' % length)
+        append(data)
+        append(b'\r\n')
+
+    def serialize_bool(self, data, append, stack):
+        append(self._SMALL_INT[1 if data else 0])
+
+    def serialize_number(self, data, append, stack):
+        if type(data) is int and 0 <= data < 1024:
+            append(self._SMALL_INT[data])
         else:
-            raise CommandError('未能识别的类型： %s' % type(data))
+            append(b':%d\r\n' % data)
+
+    def serialize_error(self, data, append, stack):
+        append(b'-%s\r\n' % encode(data.message))
+
+    def serialize_array(self, data, append, stack):
+        append(b'*%d\r\n' % len(data))
+        stack.append(iter(data))
+
+    def serialize_dict(self, data, append, stack):
+        append(b'%%%d\r\n' % len(data))
+        stack.append(chain.from_iterable(data.items()))
+
+    def serialize_none(self, data, append, stack):
+        append(b'$-1\r\n')
 
 
 class ClientQuit(Exception):
@@ -153,7 +408,12 @@ class Shutdown(CommandError):
 
 
 class Server(object):
-    def __init__(self, host='127.0.0.1', port=33333, max_clients=64):
+    def __init__(self, host='127.0.0.1', port=33333, max_clients=64,
+                 processes=1):
+        # processes > 1 时预先 fork 出多个进程，各自用 SO_REUSEPORT 监听同一端口，
+        # 由内核分配连接。每个进程有独立的存储，不共享数据。
+        self._address = (host, port)
+        self._processes = processes
         self._pool = Pool(max_clients)
         self._server = StreamServer(
             (host, port),
@@ -161,13 +421,13 @@ class Server(object):
             spawn=self._pool)
 
         self._protocol = ProtocolHandler()
-        self._kv = {}
+        self._kv = [{} for _ in range(SHARD_COUNT)]
 
         self._commands = self.get_commands()
         self._schedule = []
 
     def get_commands(self):
-        return {
+        commands = {
             b'GET': self.get,
             b'SET': self.set,
             b'DELETE': self.delete,
@@ -180,55 +440,194 @@ class Server(object):
             b'QUIT': self.client_quit,
             b'SHUTDOWN': self.shutdown,
         }
+        # 同时登记小写形式，常见的全大写/全小写命令无需再调用 upper()
+        commands.update({name.lower(): fn for name, fn in commands.items()})
+        return commands
 
     def get_response(self, data):
         # 解压客户端发送的数据，执行它们指定的命令，并传回返回值
+        if isinstance(data, Batch):
+            return [self._batch_response(command) for command in data]
+        if isinstance(data, BatchError):
+            return data
+
         if not isinstance(data, list):
             try:
                 data = data.split()
             except:
-                raise CommandError('Request must be list or simple string.')
+                return ERR_BAD_REQUEST
 
         if not data:
-            raise CommandError('Missing command')
+            return ERR_MISSING_COMMAND
+
+        command = data[0]
+        cmd_fn = self._commands.get(command)
+        if cmd_fn is None:
+            # 大小写混合的命令才需要规范化；命令名不是字符串时直接报未知命令
+            if not isinstance(command, bytes):
+                raise CommandError('Unrecognized command: %s' % (command,))
+            command = command.upper()
+            cmd_fn = self._commands.get(command)
+            if cmd_fn is None:
+                raise CommandError('Unrecognized command: %s' % command)
+        # GET/DELETE 和 SET 等定长命令直接按下标传参，省去切片和解包
+        argc = len(data)
+        if argc == 2:
+            return cmd_fn(data[1])
+        if argc == 3:
+            return cmd_fn(data[1], data[2])
+        return cmd_fn(*data[1:])
+
+    def _batch_response(self, data):
+        # 批量中单条命令出错只影响它自己的返回值
+        try:
+            return self.get_response(data)
+        except CommandError as exc:
+            return Error(exc.message)
+        except TypeError as exc:
+            # 参数个数不对
+            return Error('Invalid arguments: %s' % exc)
 
-        command = data[0].upper()
-        if command not in self._commands:
-            raise CommandError('Unrecognized command: %s' % command)
-        return self._commands[command](*data[1:])
+    def _items(self):
+        return chain.from_iterable(shard.items() for shard in self._kv)
 
     def _get_state(self):
-        return {'kv': self._kv, 'schedule': self._schedule}
+        # hash() 每个进程不同，分片无法原样保存，合并成一个字典
+        kv = {}
+        for shard in self._kv:
+            kv.update(shard)
+        return {'kv': kv, 'schedule': self._schedule}
 
     def _set_state(self, state, merge=False):
         if not merge:
-            self._kv = state['kv']
-            self._schedule = state['schedule']
-        else:
-            def merge(orig, updates):
-                orig.update(updates)
-                return orig
-
-            self._kv = merge(state['kv'], self._kv)
-            self._schedule = state['schedule']
+            self._kv = [{} for _ in range(SHARD_COUNT)]
+        kv = self._kv
+        for key, value in state['kv'].items():
+            shard = kv[hash(key) & SHARD_MASK]
+            if merge:
+                # 合并时以内存中已有的值为准
+                shard.setdefault(key, value)
+            else:
+                shard[key] = value
+        self._schedule = state['schedule']
 
     # 持久化，保存到磁盘。类似于Redis的RDB持久化。
     def save_to_disk(self):
         filename = FILE_NAME
-        with open(filename, 'wb') as fh:
-            pickle.dump(self._get_state(), fh, pickle.HIGHEST_PROTOCOL)
+        if self._processes > 1:
+            # 多进程时各进程存储独立，按 pid 区分保存文件
+            filename = '%s.%d' % (FILE_NAME, os.getpid())
+        if not self._schedule and all(
+                type(key) is bytes and type(value) is bytes
+                for key, value in self._items()):
+            self._save_kv(filename)
+        else:
+            self._save_pickle(filename, self._get_state())
         print('已保存到磁盘。')
         return True
 
+    def _save_kv(self, filename):
+        # 键值都是 bytes 时使用紧凑的二进制格式，不经过 pickle
+        size = len(KV_MAGIC) + sum(
+            KV_HEADER.size + len(key) + len(value)
+            for key, value in self._items())
+        buf = bytearray(size)
+        buf[:len(KV_MAGIC)] = KV_MAGIC
+        offset = len(KV_MAGIC)
+        pack_into = KV_HEADER.pack_into
+        for key, value in self._items():
+            key_len = len(key)
+            value_len = len(value)
+            pack_into(buf, offset, key_len, value_len)
+            offset += KV_HEADER.size
+            buf[offset:offset + key_len] = key
+            offset += key_len
+            buf[offset:offset + value_len] = value
+            offset += value_len
+        with open(filename, 'wb') as fh:
+            if lz4 is None:
+                fh.write(buf)
+                return
+            # 压缩减少写盘的字节数，保存时 CPU 空闲，瓶颈在磁盘带宽
+            fh.write(KV_LZ4_MAGIC)
+            with lz4.frame.LZ4FrameFile(
+                    fh, 'wb', block_size=lz4.frame.BLOCKSIZE_MAX1MB) as zf:
+                zf.write(memoryview(buf)[len(KV_MAGIC):])
+
+    def _save_pickle(self, filename, state):
+        # 大的 bytes 值包成 PickleBuffer，由 buffer_callback 收集后零拷贝写出
+        state['kv'] = {
+            key: pickle.PickleBuffer(value)
+            if type(value) is bytes and len(value) >= OOB_THRESHOLD else value
+            for key, value in state['kv'].items()}
+        buffers = []
+        with open(filename, 'wb', buffering=1 << 20) as fh:
+            fh.write(SAVE_MAGIC + struct.pack('<Q', 0))
+            pickler = pickle.Pickler(fh, protocol=5,
+                                     buffer_callback=buffers.append)
+            pickler.dump(state)
+            pickle_len = fh.tell() - len(SAVE_MAGIC) - 8
+            for buf in buffers:
+                raw = buf.raw()
+                fh.write(struct.pack('<Q', raw.nbytes))
+                fh.write(raw)
+            fh.seek(len(SAVE_MAGIC))
+            fh.write(struct.pack('<Q', pickle_len))
+
     # 从磁盘恢复
     def restore_from_disk(self, filename, merge=False):
         if not os.path.exists(filename):
             return False
-        with open(filename, 'rb') as fh:
-            state = pickle.load(fh)
+        with open(filename, 'rb', buffering=1 << 20) as fh:
+            magic = fh.read(len(SAVE_MAGIC))
+            if magic == KV_MAGIC:
+                state = {'kv': self._load_kv(fh), 'schedule': []}
+            elif magic == KV_LZ4_MAGIC:
+                if lz4 is None:
+                    raise CommandError('需要安装 lz4 才能恢复该文件。')
+                with lz4.frame.LZ4FrameFile(fh, 'rb') as zf:
+                    state = {'kv': self._parse_kv(zf.read(), 0),
+                             'schedule': []}
+            elif magic == SAVE_MAGIC:
+                state = self._load_pickle(fh)
+            else:
+                # 旧格式：整个文件就是一个 pickle
+                fh.seek(0)
+                state = pickle.load(fh)
         self._set_state(state, merge=merge)
         return True
 
+    def _load_kv(self, fh):
+        # mmap 映射文件，按长度前缀直接切出键和值，省去 read 的额外拷贝
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return self._parse_kv(mm, len(KV_MAGIC))
+
+    def _parse_kv(self, data, offset):
+        kv = {}
+        unpack_from = KV_HEADER.unpack_from
+        total = len(data)
+        while offset < total:
+            key_len, value_len = unpack_from(data, offset)
+            offset += KV_HEADER.size
+            key = data[offset:offset + key_len]
+            offset += key_len
+            kv[key] = data[offset:offset + value_len]
+            offset += value_len
+        return kv
+
+    def _load_pickle(self, fh):
+        pickle_len, = struct.unpack('<Q', fh.read(8))
+        start = fh.tell()
+        fh.seek(start + pickle_len)
+        buffers = []
+        header = fh.read(8)
+        while header:
+            length, = struct.unpack('<Q', header)
+            buffers.append(fh.read(length))
+            header = fh.read(8)
+        fh.seek(start)
+        return pickle.Unpickler(fh, buffers=buffers).load()
+
     # 从磁盘合并
     def merge_from_disk(self, filename):
         return self.restore_from_disk(filename, merge=True)
@@ -241,61 +640,104 @@ class Server(object):
 
     # 操作
     def get(self, key):
-        return self._kv.get(key)
+        return self._kv[hash(key) & SHARD_MASK].get(key)
 
     def set(self, key, value):
-        self._kv[key] = value
+        self._kv[hash(key) & SHARD_MASK][key] = value
         return 1
 
     def mget(self, *keys):
-        return [self._kv.get(key) for key in keys]
+        # 分片后逐个按键选分片；按分片分组再 map(shard.get) 实测更慢
+        kv = self._kv
+        return [kv[hash(key) & SHARD_MASK].get(key) for key in keys]
 
     def mset(self, *items):
-        data = list(zip(items[::2], items[1::2]))
-        for key, value in data:
-            self._kv[key] = value
-        return len(data)
+        kv = self._kv
+        for i in range(0, len(items) - 1, 2):
+            key = items[i]
+            kv[hash(key) & SHARD_MASK][key] = items[i + 1]
+        return len(items) >> 1
 
     def delete(self, key):
-        if key in self._kv:
-            del self._kv[key]
+        shard = self._kv[hash(key) & SHARD_MASK]
+        if key in shard:
+            del shard[key]
             return 1
         return 0
 
     def flush(self):
-        kv_len = len(self._kv)
-        self._kv.clear()
+        kv_len = 0
+        for shard in self._kv:
+            kv_len += len(shard)
+            shard.clear()
         return kv_len
 
     def quit(self):
         pass
 
     def connection_handler(self, conn, address):
-        # 将conn（套接字对象）转换为类文件的对象
-        socket_file = conn.makefile('rwb')
+        # 关闭 Nagle 算法，小响应立即发出。收发缓冲区交给内核自动调整
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # 读取用 recv_into 写入复用的缓冲区，写入走 conn.sendall
+        reader = RecvBuffer()
 
         # 处理客户端请求，直到客户端断开连接
         while True:
             try:
-                data = self._protocol.handle_request(socket_file)
+                data = self._protocol.handle_request(conn, reader)
             except Disconnect:
                 break
             except EOFError:
-                socket_file.close()
+                conn.close()
                 print('客户端关闭连接。')
                 break
+
+            # 客户端使用流水线时，缓冲区里已收到的请求全部处理完再统一发送响应，
+            # 没有待处理的请求时立即发送，不增加延迟
+            responses = []
+            client_quit = False
+            try:
+                while True:
+                    try:
+                        resp = self.get_response(data)
+                    except CommandError as exc:
+                        resp = Error(exc.message)
+                    responses.append(resp)
+
+                    data = self._protocol.next_buffered(reader)
+                    if data is _INCOMPLETE:
+                        break
             except ClientQuit:
+                client_quit = True
+            finally:
+                # 后面的命令出错或客户端退出时，已执行命令的响应仍要发出
+                if responses:
+                    self._protocol.write_responses(conn, responses)
+
+            if client_quit:
+                conn.close()
                 print('客户端关闭连接。')
                 break
 
-            try:
-                resp = self.get_response(data)
-            except CommandError as exc:
-                resp = Error(exc.args[0])
-
-            self._protocol.write_response(socket_file, resp)
+    def _create_listener(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self._address)
+        sock.listen(socket.SOMAXCONN)
+        return sock
 
     def run(self):
+        if self._processes > 1:
+            for _ in range(self._processes - 1):
+                if gevent.fork() == 0:
+                    break
+            # fork 之后每个进程各自创建监听套接字
+            self._server = StreamServer(
+                self._create_listener(),
+                self.connection_handler,
+                spawn=self._pool)
         self._server.serve_forever()
 
 
@@ -304,16 +746,41 @@ class Client(object):
         self._protocol = ProtocolHandler()
         # AF_INET 面向网络的； 为了创建 TCP套接字，必须使用 SOCK_STREAM 作为套接字类型。
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._socket.connect((host, port))
-        self._fh = self._socket.makefile('rwb')
+        self._reader = RecvBuffer()
 
     def execute(self, *args):
-        self._protocol.write_response(self._fh, args)
-        resp = self._protocol.handle_request(self._fh)
+        self._protocol.write_response(self._socket, args)
+        resp = self._protocol.handle_request(self._socket, self._reader)
         if isinstance(resp, Error):
             raise CommandError(resp.message)
         return resp
 
+    def execute_batch(self, commands):
+        # 用 msgpack 一次发送多条命令，返回与之对应的结果列表，出错的命令对应 Error
+        if msgspec is None:
+            raise CommandError('需要安装 msgspec 才能批量执行命令。')
+        # 参数按 RESP 路径的方式转换，服务器不接受的类型在发送前就报错
+        batch = []
+        for command in commands:
+            if not isinstance(command, (list, tuple)):
+                raise CommandError('每条命令必须是参数列表： %r' % (command,))
+            args = []
+            for arg in command:
+                if isinstance(arg, str):
+                    arg = arg.encode('utf-8')
+                elif isinstance(arg, bool):
+                    arg = int(arg)
+                elif arg is not None and not isinstance(
+                        arg, (bytes, int, float)):
+                    raise CommandError('未能识别的类型： %s' % type(arg))
+                args.append(arg)
+            batch.append(args)
+        payload = msgspec.msgpack.encode(batch)
+        self._socket.sendall(b'!' + len(payload).to_bytes(4, 'big') + payload)
+        return self._protocol.handle_request(self._socket, self._reader)
+
     def command(cmd):
         def method(self, *args):
             return self.execute(cmd.encode('utf-8'), *args)